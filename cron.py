@@ -68,6 +68,10 @@ def process_company(company_name):
             
         # Step 3: Save results as pickle file
         output_path = os.path.join(OUTPUT_DIR, f"{company_name.lower()}.pkl")
+        if result.get("Incomplete") and os.path.exists(output_path):
+            logger.warning(f"Partial analysis for {company_name}; keeping previous results at {output_path}")
+            return False
+
         with open(output_path, 'wb') as f:
             pickle.dump(result, f)
             
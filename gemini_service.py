@@ -8,6 +8,7 @@ import os
 import logging
 import google.generativeai as genai
 import json
+import re
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -41,6 +42,7 @@ Provide your response in structured JSON format as follows:
   "Company": "{company_name}",
   "Articles": [
     {{
+      "Article Number": number,
       "Title": "Article title",
       "Summary": "Brief summary",
       "Sentiment": "Positive/Negative/Neutral",
@@ -73,9 +75,277 @@ Here are the articles about {company_name}:
     prompt += "\nPlease analyze these articles and provide the response in JSON format."
     return prompt
 
+def generate_repair_prompt(company_name, articles, missing_indices, analyzed_articles=None,
+                           need_final_sentiment=False):
+    """
+    Generate a small follow-up prompt asking Gemini to re-analyze only the
+    articles that could not be recovered from the first response. When the final
+    sentiment is also needed, the already analyzed articles are included as context.
+    """
+    prompt = f"""You are a financial news analyst analyzing news articles about {company_name}.
+For each article below, summarize it concisely, determine its sentiment (Positive, Negative, or Neutral)
+and extract its key topics."""
+    if need_final_sentiment:
+        prompt += f"""
+Then provide an overall sentiment analysis for {company_name} based on all articles,
+including the already analyzed articles listed below."""
+    prompt += """
+
+Provide your response in structured JSON format as follows:
+```
+{
+  "Articles": [
+    {
+      "Article Number": number,
+      "Title": "Article title",
+      "Summary": "Brief summary",
+      "Sentiment": "Positive/Negative/Neutral",
+      "Topics": ["Topic1", "Topic2", "Topic3"]
+    }
+  ]"""
+    if need_final_sentiment:
+        prompt += f""",
+  "Final Sentiment Analysis": "Overall sentiment summary for {company_name}\""""
+    prompt += """
+}
+```
+"""
+
+    if need_final_sentiment and analyzed_articles:
+        prompt += "\nHere are the already analyzed articles:\n"
+        for article in analyzed_articles:
+            prompt += f"\n- TITLE: {article['Title']}\n"
+            prompt += f"  SENTIMENT: {article['Sentiment']}\n"
+            prompt += f"  SUMMARY: {article['Summary']}\n"
+
+    prompt += "\nHere are the articles to analyze:\n"
+    for i in missing_indices:
+        article = articles[i]
+        prompt += f"\n--- ARTICLE {i+1} ---\n"
+        prompt += f"TITLE: {article.get('title', 'No title')}\n"
+        prompt += f"CONTENT: {article.get('content', 'No content')}\n"
+
+    prompt += "\nPlease analyze these articles and provide the response in JSON format."
+    return prompt
+
+VALID_SENTIMENTS = ("Positive", "Negative", "Neutral")
+
+_decoder = json.JSONDecoder()
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_ARTICLES_RE = re.compile(r'"Articles"\s*:\s*\[')
+_NEXT_ENTRY_RE = re.compile(r",\s*\{")
+
+def _decode_at(text, pos):
+    """
+    Decode a single JSON value starting at pos, returning (value, end) or (None, pos)
+    """
+    try:
+        return _decoder.raw_decode(text, pos)
+    except json.JSONDecodeError:
+        return None, pos
+
+def _decode_object(text):
+    """
+    Decode the first complete JSON object in text, tolerating surrounding prose
+    and trailing commas
+    """
+    if "{" not in text:
+        return None
+    for candidate in (text, _TRAILING_COMMA_RE.sub(r"\1", text)):
+        value, _ = _decode_at(candidate, candidate.find("{"))
+        if isinstance(value, dict):
+            return value
+    return None
+
+def _decode_field(text, key):
+    """
+    Decode the value of a top-level key from a response that is not valid JSON as a whole
+    """
+    match = re.search(r'"%s"\s*:\s*' % re.escape(key), text)
+    if not match:
+        return None
+    value, _ = _decode_at(text, match.end())
+    return value
+
+def _salvage_articles(text):
+    """
+    Walk the Articles array one entry at a time, keeping every entry that decodes
+    and skipping to the next object whenever one is malformed
+    """
+    match = _ARTICLES_RE.search(text)
+    if not match:
+        return []
+
+    entries = []
+    pos = match.end()
+    while pos < len(text):
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        if text[pos] == "{":
+            value, end = _decode_at(text, pos)
+            if end > pos:
+                entries.append(value)
+                pos = end
+                continue
+        # Malformed entry: resume at the next object in the array, if any
+        next_entry = _NEXT_ENTRY_RE.search(text, pos + 1)
+        if not next_entry:
+            break
+        pos = next_entry.end() - 1
+    return entries
+
+def parse_response(text):
+    """
+    Parse a Gemini response, salvaging whatever parts are well-formed.
+    Returns a dict (possibly partial) or None if nothing could be recovered.
+    """
+    result = _decode_object(text)
+    if result is not None:
+        return result
+
+    articles = _salvage_articles(text)
+    result = {"Articles": articles} if articles else {}
+    for key in ("Company", "Comparative Analysis", "Final Sentiment Analysis"):
+        value = _decode_field(text, key)
+        if value is not None:
+            result[key] = value
+    return result or None
+
+def normalize_article(entry):
+    """
+    Clean up common formatting slips in an analyzed article (sentiment casing and
+    whitespace, topics given as a comma-separated string, numbers given as strings)
+    """
+    if not isinstance(entry, dict):
+        return entry
+    entry = dict(entry)
+    for key in ("Title", "Summary"):
+        if isinstance(entry.get(key), str):
+            entry[key] = entry[key].strip()
+    if isinstance(entry.get("Sentiment"), str):
+        entry["Sentiment"] = entry["Sentiment"].strip().title()
+    topics = entry.get("Topics")
+    if topics is None:
+        entry["Topics"] = []
+    elif isinstance(topics, str):
+        entry["Topics"] = [topic.strip() for topic in topics.split(",") if topic.strip()]
+    elif isinstance(topics, list):
+        entry["Topics"] = [str(topic).strip() for topic in topics if str(topic).strip()]
+    number = entry.get("Article Number")
+    if isinstance(number, str) and number.strip().isdigit():
+        entry["Article Number"] = int(number.strip())
+    return entry
+
+def is_valid_article(entry):
+    """
+    Check that an analyzed article matches the expected schema
+    """
+    if not isinstance(entry, dict):
+        return False
+    for key in ("Title", "Summary"):
+        if not isinstance(entry.get(key), str) or not entry[key].strip():
+            return False
+    if entry.get("Sentiment") not in VALID_SENTIMENTS:
+        return False
+    topics = entry.get("Topics")
+    return isinstance(topics, list) and all(isinstance(topic, str) for topic in topics)
+
+def _normalize_title(title):
+    return " ".join(str(title).lower().split())
+
+def _match_articles(entries, articles, indices):
+    """
+    Map valid analyzed entries onto the requested input articles by article number,
+    then by title, then by position when the response array is intact.
+    Entries that cannot be placed are left out so their articles get re-requested.
+    """
+    titles = {}
+    for i in indices:
+        titles.setdefault(_normalize_title(articles[i].get("title", "")), []).append(i)
+    aligned = len(entries) == len(indices)
+
+    def first_unmatched(candidates):
+        return next((i for i in candidates if i not in matched), None)
+
+    matched = {}
+    pending = []
+    for position, entry in enumerate(entries):
+        entry = normalize_article(entry)
+        if not is_valid_article(entry):
+            continue
+        number = entry.pop("Article Number", None)
+        if isinstance(number, int) and number - 1 in indices and number - 1 not in matched:
+            matched[number - 1] = entry
+        else:
+            pending.append((position, entry))
+
+    unplaced = []
+    for position, entry in pending:
+        index = first_unmatched(titles.get(_normalize_title(entry["Title"]), []))
+        if index is not None:
+            matched[index] = entry
+        else:
+            unplaced.append((position, entry))
+
+    if aligned:
+        for position, entry in unplaced:
+            if indices[position] not in matched:
+                matched[indices[position]] = entry
+    return matched
+
+def _is_valid_comparative_analysis(analysis):
+    if not isinstance(analysis, dict):
+        return False
+    distribution = analysis.get("Sentiment Distribution")
+    overlap = analysis.get("Topic Overlap")
+    return (isinstance(distribution, dict)
+            and all(isinstance(distribution.get(s), int) for s in VALID_SENTIMENTS)
+            and isinstance(overlap, dict)
+            and isinstance(overlap.get("Common Topics"), list)
+            and isinstance(overlap.get("Unique Topics"), list))
+
+def build_comparative_analysis(analyzed_articles):
+    """
+    Build the comparative analysis locally from the analyzed articles
+    """
+    distribution = {sentiment: 0 for sentiment in VALID_SENTIMENTS}
+    topic_counts = {}
+    for article in analyzed_articles:
+        distribution[article["Sentiment"]] += 1
+        for topic in dict.fromkeys(article["Topics"]):
+            topic_counts[topic] = topic_counts.get(topic, 0) + 1
+
+    return {
+        "Sentiment Distribution": distribution,
+        "Topic Overlap": {
+            "Common Topics": [topic for topic, count in topic_counts.items() if count > 1],
+            "Unique Topics": [topic for topic, count in topic_counts.items() if count == 1]
+        }
+    }
+
+def build_final_sentiment(company_name, comparative_analysis):
+    """
+    Build an overall sentiment summary locally from the sentiment distribution
+    """
+    distribution = comparative_analysis["Sentiment Distribution"]
+    top = max(distribution.get(sentiment, 0) for sentiment in VALID_SENTIMENTS)
+    leaders = [sentiment for sentiment in VALID_SENTIMENTS if distribution.get(sentiment, 0) == top]
+    overall = leaders[0] if len(leaders) == 1 else "Mixed"
+    counts = ", ".join(f"{distribution.get(sentiment, 0)} {sentiment.lower()}" for sentiment in VALID_SENTIMENTS)
+    return f"Overall news sentiment for {company_name} is {overall} ({counts} articles)."
+
+def _generate(model, prompt):
+    response = model.generate_content(prompt)
+    return response.text
+
 def process_articles(company_name, articles):
     """
-    Process articles using Gemini model for sentiment analysis
+    Process articles using Gemini model for sentiment analysis.
+    Well-formed articles from the response are kept, and only missing or invalid
+    articles are re-requested in a single follow-up prompt. If some articles are
+    still missing afterwards, the result is returned with "Incomplete" set to True.
     """
     if not GOOGLE_API_KEY:
         logger.error("GOOGLE_API_KEY not set. Cannot proceed with Gemini analysis.")
@@ -86,21 +356,68 @@ def process_articles(company_name, articles):
     
     try:
         logger.info(f"Sending request to Gemini model for {company_name}")
-        response = model.generate_content(prompt)
-        response_text = response.text
-        
-        # Extract JSON response
-        json_start = response_text.find("{")
-        json_end = response_text.rfind("}") + 1
-        json_str = response_text[json_start:json_end]
-        result = json.loads(json_str)
-        
-        logger.info(f"Successfully processed articles for {company_name}")
-        return result
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing JSON response from Gemini: {e}")
-        return None
+        response_text = _generate(model, prompt)
     except Exception as e:
         logger.error(f"Error using Gemini model: {e}")
         return None
 
+    result = parse_response(response_text) or {}
+    entries = result.get("Articles") if isinstance(result.get("Articles"), list) else []
+    matched = _match_articles(entries, articles, list(range(len(articles))))
+    final_sentiment = result.get("Final Sentiment Analysis")
+    if not isinstance(final_sentiment, str) or not final_sentiment.strip():
+        final_sentiment = None
+
+    missing = [i for i in range(len(articles)) if i not in matched]
+    repaired = False
+    if missing:
+        need_final_sentiment = final_sentiment is None
+        logger.warning(f"Gemini response for {company_name} is incomplete: "
+                       f"{len(matched)}/{len(articles)} articles recovered; re-requesting {len(missing)} articles"
+                       + (" and the final sentiment" if need_final_sentiment else ""))
+        repair_prompt = generate_repair_prompt(company_name, articles, missing,
+                                               analyzed_articles=[matched[i] for i in sorted(matched)],
+                                               need_final_sentiment=need_final_sentiment)
+        try:
+            repair = parse_response(_generate(model, repair_prompt)) or {}
+        except Exception as e:
+            logger.error(f"Error using Gemini model for follow-up request: {e}")
+            repair = {}
+
+        repair_entries = repair.get("Articles") if isinstance(repair.get("Articles"), list) else []
+        for index, entry in _match_articles(repair_entries, articles, missing).items():
+            matched[index] = entry
+            repaired = True
+
+        if need_final_sentiment and isinstance(repair.get("Final Sentiment Analysis"), str):
+            final_sentiment = repair["Final Sentiment Analysis"].strip() or None
+
+    if not matched:
+        logger.error(f"Could not recover any analyzed articles from Gemini for {company_name}")
+        return None
+
+    analyzed_articles = [matched[i] for i in sorted(matched)]
+    incomplete = len(analyzed_articles) < len(articles)
+    comparative_analysis = result.get("Comparative Analysis")
+    if repaired or incomplete or not _is_valid_comparative_analysis(comparative_analysis):
+        comparative_analysis = build_comparative_analysis(analyzed_articles)
+
+    if incomplete:
+        # Keep the summary consistent with the articles actually returned
+        logger.warning(f"Returning partial analysis for {company_name}: "
+                       f"{len(analyzed_articles)}/{len(articles)} articles")
+        final_sentiment = build_final_sentiment(company_name, comparative_analysis)
+    elif final_sentiment is None:
+        logger.warning(f"Final sentiment missing from Gemini response for {company_name}; deriving it locally")
+        final_sentiment = build_final_sentiment(company_name, comparative_analysis)
+
+    if not incomplete:
+        logger.info(f"Successfully processed articles for {company_name}")
+
+    return {
+        "Company": company_name,
+        "Articles": analyzed_articles,
+        "Comparative Analysis": comparative_analysis,
+        "Final Sentiment Analysis": final_sentiment,
+        "Incomplete": incomplete
+    }
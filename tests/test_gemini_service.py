@@ -0,0 +1,160 @@
+import types
+
+import pytest
+
+from utils import gemini_service
+
+
+ARTICLES = [
+    {"title": "Acme beats earnings", "content": "..."},
+    {"title": "Acme faces lawsuit", "content": "..."},
+    {"title": "Acme opens new office", "content": "..."},
+]
+
+FULL_RESPONSE = """{
+  "Company": "Acme",
+  "Articles": [
+    {"Article Number": 1, "Title": "Acme beats earnings", "Summary": "Strong quarter", "Sentiment": "Positive", "Topics": ["Earnings"]},
+    {"Article Number": 2, "Title": "Acme faces lawsuit", "Summary": "Legal trouble", "Sentiment": "Negative", "Topics": ["Legal"]},
+    {"Article Number": 3, "Title": "Acme opens new office", "Summary": "Expansion", "Sentiment": "Neutral", "Topics": ["Expansion", "Earnings"]}
+  ],
+  "Comparative Analysis": {
+    "Sentiment Distribution": {"Positive": 1, "Negative": 1, "Neutral": 1},
+    "Topic Overlap": {"Common Topics": ["Earnings"], "Unique Topics": ["Legal", "Expansion"]}
+  },
+  "Final Sentiment Analysis": "Mixed outlook"
+}"""
+
+
+class FakeModel:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def generate_content(self, prompt):
+        self.prompts.append(prompt)
+        return types.SimpleNamespace(text=self.responses.pop(0))
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    def install(*responses):
+        model = FakeModel(responses)
+        monkeypatch.setattr(gemini_service, "GOOGLE_API_KEY", "test-key")
+        monkeypatch.setattr(gemini_service.genai, "GenerativeModel", lambda name: model, raising=False)
+        return model
+    return install
+
+
+def test_fenced_json_is_parsed():
+    result = gemini_service.parse_response(f"Here is the analysis:\n```json\n{FULL_RESPONSE}\n```")
+    assert result["Final Sentiment Analysis"] == "Mixed outlook"
+    assert len(result["Articles"]) == 3
+
+
+def test_prose_with_brace_before_json_is_parsed():
+    text = "Note: fields use the {key: value} layout.\n" + FULL_RESPONSE
+    result = gemini_service.parse_response(text)
+    assert len(result["Articles"]) == 3
+
+
+def test_trailing_commas_are_repaired():
+    text = FULL_RESPONSE.replace('"Topics": ["Legal"]}', '"Topics": ["Legal"],}')
+    text = text.replace('"Earnings"]}\n  ]', '"Earnings"]},\n  ]')
+    assert text.count(",}") == 1 and "},\n  ]" in text
+    result = gemini_service.parse_response(text)
+    assert len(result["Articles"]) == 3
+
+
+def test_malformed_middle_entry_is_skipped():
+    text = FULL_RESPONSE.replace('"Summary": "Legal trouble",', '"Summary": "Legal trouble,')
+    result = gemini_service.parse_response(text)
+    assert [a["Title"] for a in result["Articles"]] == ["Acme beats earnings", "Acme opens new office"]
+    assert result["Final Sentiment Analysis"] == "Mixed outlook"
+
+
+def test_normalizes_sentiment_and_topics():
+    entry = {"Title": "A", "Summary": "s", "Sentiment": "Neutral ", "Topics": "Legal, Earnings"}
+    normalized = gemini_service.normalize_article(entry)
+    assert normalized["Sentiment"] == "Neutral"
+    assert normalized["Topics"] == ["Legal", "Earnings"]
+    assert gemini_service.is_valid_article(normalized)
+
+
+def test_position_fallback_does_not_steal_another_article():
+    entry = {"Summary": "s", "Sentiment": "Neutral", "Topics": []}
+    articles = [{"title": "X0"}, {"title": "X1"}]
+    matched = gemini_service._match_articles([dict(entry, Title="X0"), dict(entry, Title="Paraphrased")],
+                                             articles, [0, 1])
+    assert matched[0]["Title"] == "X0"
+    assert matched[1]["Title"] == "Paraphrased"
+
+    matched = gemini_service._match_articles([dict(entry, Title="Paraphrased"), dict(entry, Title="X0")],
+                                             articles, [0, 1])
+    assert list(matched) == [0]
+
+
+def test_complete_response_uses_single_call(fake_model):
+    response = FULL_RESPONSE.replace('"Positive", "Topics"', '"positive", "Topics"')
+    response = response.replace('"Neutral", "Topics"', '"Neutral ", "Topics"')
+    model = fake_model(response)
+    result = gemini_service.process_articles("Acme", ARTICLES)
+    assert len(model.prompts) == 1
+    assert result["Incomplete"] is False
+    assert result["Final Sentiment Analysis"] == "Mixed outlook"
+    assert [a["Sentiment"] for a in result["Articles"]] == ["Positive", "Negative", "Neutral"]
+
+
+def test_truncated_response_derives_final_sentiment_locally(fake_model):
+    truncated = FULL_RESPONSE[:FULL_RESPONSE.index('"Topic Overlap"')]
+    model = fake_model(truncated)
+    result = gemini_service.process_articles("Acme", ARTICLES)
+    assert len(model.prompts) == 1
+    assert len(result["Articles"]) == 3
+    assert result["Incomplete"] is False
+    assert result["Final Sentiment Analysis"].startswith("Overall news sentiment for Acme is Mixed")
+
+
+def test_follow_up_requests_only_missing_articles(fake_model):
+    broken = FULL_RESPONSE.replace('"Summary": "Legal trouble",', '"Summary": "Legal trouble,')
+    follow_up = ('{"Articles": [{"Title": "Acme faces lawsuit", "Summary": "Legal trouble", '
+                 '"Sentiment": "Negative", "Topics": ["Legal"]}]}')
+    model = fake_model(broken, follow_up)
+    result = gemini_service.process_articles("Acme", ARTICLES)
+    assert len(model.prompts) == 2
+    assert "ARTICLE 2" in model.prompts[1]
+    assert "ARTICLE 1" not in model.prompts[1] and "ARTICLE 3" not in model.prompts[1]
+    assert [a["Title"] for a in result["Articles"]] == [a["title"] for a in ARTICLES]
+    assert result["Incomplete"] is False
+    assert result["Comparative Analysis"]["Sentiment Distribution"] == {"Positive": 1, "Negative": 1, "Neutral": 1}
+
+
+def test_follow_up_with_renumbered_entries(fake_model):
+    broken = FULL_RESPONSE.replace('"Summary": "Strong quarter",', '"Summary": "Strong quarter,')
+    broken = broken.replace('"Summary": "Expansion",', '"Summary": "Expansion,')
+    # The model renumbers the two re-requested articles as 1 and 2 instead of 1 and 3
+    follow_up = ('{"Articles": ['
+                 '{"Article Number": 1, "Title": "Acme beats earnings", "Summary": "Strong quarter", '
+                 '"Sentiment": "Positive", "Topics": ["Earnings"]},'
+                 '{"Article Number": 2, "Title": "Acme opens new office", "Summary": "Expansion", '
+                 '"Sentiment": "Neutral", "Topics": ["Expansion"]}]}')
+    fake_model(broken, follow_up)
+    result = gemini_service.process_articles("Acme", ARTICLES)
+    assert [a["Title"] for a in result["Articles"]] == [a["title"] for a in ARTICLES]
+    assert result["Incomplete"] is False
+
+
+def test_partial_result_is_flagged(fake_model):
+    broken = FULL_RESPONSE.replace('"Summary": "Legal trouble",', '"Summary": "Legal trouble,')
+    fake_model(broken, "Sorry, I cannot help with that.")
+    result = gemini_service.process_articles("Acme", ARTICLES)
+    assert result["Incomplete"] is True
+    assert len(result["Articles"]) == 2
+    assert result["Final Sentiment Analysis"] != "Mixed outlook"
+    assert result["Comparative Analysis"]["Sentiment Distribution"] == {"Positive": 1, "Negative": 0, "Neutral": 1}
+
+
+def test_garbage_returns_none(fake_model):
+    model = fake_model("not json at all", "still not json")
+    assert gemini_service.process_articles("Acme", ARTICLES) is None
+    assert len(model.prompts) == 2